@@ -22,7 +22,7 @@ class Metrics(enum.Enum):
         prometheus_client.Gauge,
     )
 
-    def __init__(self, title, description, prometheus_type, labels=()):
+    def __init__(self, title, description, prometheus_type, labels=(), multiprocess_mode="max"):
         # we use the above default value for labels because it matches what's used
         # in the prometheus_client library's metrics constructor, see
         # https://github.com/prometheus/client_python/blob/fd4da6cde36a1c278070cf18b4b9f72956774b05/prometheus_client/metrics.py#L115
@@ -30,16 +30,30 @@ class Metrics(enum.Enum):
         self.description = description
         self.prometheus_type = prometheus_type
         self.labels = labels
+        # how gauges from several uvicorn workers are merged, only one worker
+        # updates them and the rest report 0, so max is the real value
+        self.multiprocess_mode = multiprocess_mode
 
 
 class MetricsHandler:
+    _initialized = False
+
     @classmethod
     def init(cls) -> None:
+        # registering the same metric twice with prometheus_client raises
+        # "Duplicated timeseries", which we'd hit if the app starts up again
+        # in the same process
+        if cls._initialized:
+            return
+        cls._initialized = True
         for metric in Metrics:
+            kwargs = {}
+            if metric.prometheus_type is prometheus_client.Gauge:
+                kwargs["multiprocess_mode"] = metric.multiprocess_mode
             setattr(
                 cls,
                 metric.title,
                 metric.prometheus_type(
-                    metric.title, metric.description, labelnames=metric.labels
+                    metric.title, metric.description, labelnames=metric.labels, **kwargs
                 ),
             )
@@ -11,6 +11,12 @@ def get_args():
     parser.add_argument(
         "--port", type=int, default=3000, help="Port to run the server on"
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of uvicorn worker processes, ignored with --development since it uses reload",
+    )
     parser.add_argument(
         "--config",
         default="config.yml",
@@ -1,22 +1,27 @@
+import asyncio
+import codecs
+import concurrent.futures
+import contextlib
 import dataclasses
 import datetime
 import fnmatch
 import getpass
-import json
+import http.client
 import logging
 import os
-import queue
-import re
+import random
 import socket
-import subprocess
+import sys
+import tempfile
 import threading
 import time
 from typing import Dict, List, Optional, Tuple
 
 from fastapi import BackgroundTasks, FastAPI, Request, Response
-from fastapi.middleware.cors import CORSMiddleware
-from prometheus_client import generate_latest
-import requests
+from fastapi.responses import ORJSONResponse
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest, multiprocess
+import httpx
+import orjson
 import uvicorn
 import websocket
 import yaml
@@ -37,18 +42,81 @@ logging.getLogger("uvicorn.error").setLevel(logging.ERROR)
 
 logger = logging.getLogger(__name__)
 
-# perhaps we create a separate handler for threads
-# a queue for repo and branch
-# every webhook call adds it to the queue for repo and branch
 # we built dis city
-# we built dis city on queues and threads
-REPO_QUEUES: Dict[Tuple[str, str], queue.Queue] = {}
-
-# A Lock to ensure we don't create two threads for the same repo at once
-THREAD_MANAGER_LOCK = threading.Lock()
-
-# Track which repos have an active worker thread
-ACTIVE_WORKERS: set = set()
+# we built dis city on queues and an event loop
+# smee messages and deployments are handled on the event loop uvicorn gives
+# us, the smee thread puts messages on EVENT_QUEUE with run_coroutine_threadsafe
+EVENT_LOOP: Optional[asyncio.AbstractEventLoop] = None
+
+# tracked smee events waiting for the dispatcher task, one consumer keeps them
+# in the order github sent them. when it's full the smee thread waits before
+# reading the next message
+EVENT_QUEUE_MAX_SIZE = 128
+EVENT_QUEUE: Optional[asyncio.Queue] = None
+
+# one lock per repo and branch so only one deployment touches a checkout at a time
+DEPLOY_LOCKS: Dict[Tuple[str, str], asyncio.Lock] = {}
+
+# HEAD of the last deployment whose docker compose succeeded, a push that
+# pulls nothing newer than this has nothing to rebuild. a failed deploy
+# clears it so a redelivered push or re-run workflow gets to try again
+LAST_DEPLOYED_HEADS: Dict[Tuple[str, str], str] = {}
+
+# the newest payload waiting on a repo's lock, a burst of pushes collapses
+# into this one slot so we deploy at most once more after the current one
+PENDING_DEPLOYS: Dict[Tuple[str, str], dict] = {}
+
+# asyncio only keeps weak references to tasks, hold on to running deployments
+# and embeds so they aren't garbage collected halfway through
+BACKGROUND_TASKS: set = set()
+# on shutdown a running deployment gets this long to finish before it's
+# cancelled, which kills whatever command it was running
+BACKGROUND_TASKS_SHUTDOWN_GRACE_SECONDS = 10
+
+# what little blocking work is left (the docker socket call) goes through
+# asyncio.to_thread, which uses this instead of a pool sized for cpu count + 4
+BLOCKING_EXECUTOR_MAX_WORKERS = 2
+
+# shared so discord posts reuse one keep-alive connection instead of a new
+# tls handshake each time, opened and closed by the lifespan
+HTTP_CLIENT: Optional[httpx.AsyncClient] = None
+
+# after this many failed posts in a row we stop calling discord for a while,
+# so an outage costs each deployment nothing instead of a 10s timeout
+DISCORD_CIRCUIT_BREAKER_THRESHOLD = 5
+DISCORD_CIRCUIT_BREAKER_COOLDOWN_SECONDS = 60
+
+# a 5xx, 429 or network blip is retried with exponential backoff + jitter,
+# any other 4xx won't get better by asking again
+DISCORD_POST_MAX_ATTEMPTS = 3
+DISCORD_RETRY_BASE_DELAY_SECONDS = 0.5
+DISCORD_RETRY_MAX_DELAY_SECONDS = 5
+
+# user@hostname shown in every embed, it can't change while we're running
+ENV_STR = f"{getpass.getuser()}@{socket.gethostname()}"
+
+# only the last few characters of a command's output are kept, a docker
+# build can print megabytes and three of these have to fit in one embed
+OUTPUT_TAIL_CHARS = 1000
+# discord rejects an embed whose description is longer than this
+DISCORD_EMBED_DESCRIPTION_LIMIT = 4096
+# output is read in chunks of this size, not lines, so a progress bar that
+# never prints a newline can't overrun the stream reader's buffer
+OUTPUT_READ_CHUNK_BYTES = 2**16
+
+DOCKER_SOCKET_PATH = "/var/run/docker.sock"
+# how often the docker image disk usage gauge is refreshed
+DOCKER_DISK_USAGE_POLL_INTERVAL_SECONDS = 300
+
+# with --workers every process runs the lifespan, but only one of them may
+# listen to smee or every push would deploy once per worker
+LEADER_LOCK_PATH = os.path.join(tempfile.gettempdir(), f"sce-cicd-{args.port}.lock")
+# kept open for the life of the leader process, closing it releases the lock
+LEADER_LOCK_FILE = None
+
+# libyaml's loader is much faster than the pure python one, but only exists
+# when pyyaml was built against it
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
 # this stuff gets loaded from config.yml, see readme
 SMEE2_URL = None
@@ -78,6 +146,14 @@ class ExecutionResult:
     success: bool = False
 
 
+@dataclasses.dataclass
+class CircuitBreaker:
+    # consecutive failures, the circuit is open once this reaches the threshold
+    failures: int = 0
+    # when the circuit last opened, or when the last half-open attempt started
+    opened_at: float = 0.0
+
+
 @dataclasses.dataclass
 class DeploymentStatus:
     repo: str
@@ -91,6 +167,10 @@ class DeploymentStatus:
     is_dev: bool = False
 
 
+# keyed by webhook url
+DISCORD_CIRCUIT_BREAKERS: Dict[str, CircuitBreaker] = {}
+
+
 REQUIRED_REPO_FIELDS = {
     f.name for f in dataclasses.fields(RepoConfig)
     if f.default == dataclasses.MISSING and f.default_factory == dataclasses.MISSING
@@ -101,6 +181,13 @@ def validate_config(repo: dict):
     missing = REQUIRED_REPO_FIELDS - repo.keys()
     if missing:
         raise SystemExit(f"[config] Repo '{repo.get('name', '?')}' is missing fields: {missing}")
+    for field in ("name", "branch"):
+        # yaml reads `branch: 2024` as an int and `branch: 1.10` as 1.1,
+        # neither would ever match the branch name github sends
+        if not isinstance(repo[field], str):
+            raise SystemExit(
+                f"[config] {field} for repo '{repo['name']}' must be a string, put quotes around {repo[field]!r}"
+            )
     if not os.path.isdir(repo["path"]):
         raise SystemExit(f"[config] Path does not exist for repo '{repo['name']}': {repo['path']}")
     unknown_fields = repo.keys() - {f.name for f in dataclasses.fields(RepoConfig)} # set of all fields in RepoConfig
@@ -111,7 +198,20 @@ def validate_config(repo: dict):
 
 
 
-def run_command(command_args: list, cwd: str) -> ExecutionResult:
+async def read_output_tail(stream: asyncio.StreamReader) -> str:
+    # a multibyte character can be split across two chunks
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    tail = ""
+    while True:
+        chunk = await stream.read(OUTPUT_READ_CHUNK_BYTES)
+        if not chunk:
+            break
+        tail = (tail + decoder.decode(chunk))[-OUTPUT_TAIL_CHARS:]
+    tail = (tail + decoder.decode(b"", final=True))[-OUTPUT_TAIL_CHARS:]
+    return "\n".join(line.rstrip() for line in tail.splitlines()).strip()
+
+
+async def run_command(command_args: list, cwd: str) -> ExecutionResult:
     cmd_str = " ".join(command_args)
     
     if args.development:
@@ -125,14 +225,44 @@ def run_command(command_args: list, cwd: str) -> ExecutionResult:
         )
 
     try:
-        process = subprocess.run(
-            command_args, cwd=cwd, capture_output=True, text=True, timeout=300
+        process = await asyncio.create_subprocess_exec(
+            *command_args,
+            cwd=cwd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
         )
+        # drain both pipes as the command runs so a chatty build never
+        # stalls on a full pipe buffer
+        readers = [
+            asyncio.create_task(read_output_tail(process.stdout)),
+            asyncio.create_task(read_output_tail(process.stderr)),
+        ]
+        try:
+            # both pipes reach EOF once the command exits
+            done, pending = await asyncio.wait(
+                readers, timeout=300, return_when=asyncio.FIRST_EXCEPTION
+            )
+            for reader in done:
+                reader.result()
+            if pending:
+                raise asyncio.TimeoutError
+            stdout, stderr = (reader.result() for reader in readers)
+            await process.wait()
+        finally:
+            # a timeout, a reader blowing up or being cancelled must not leave
+            # the command or the other reader running behind our back
+            for reader in readers:
+                reader.cancel()
+            await asyncio.gather(*readers, return_exceptions=True)
+            if process.returncode is None:
+                with contextlib.suppress(ProcessLookupError):
+                    process.kill()
+                await process.wait()
         return ExecutionResult(
             command=cmd_str,
             exit_code=process.returncode,
-            stdout=process.stdout.strip(),
-            stderr=process.stderr.strip(),
+            stdout=stdout,
+            stderr=stderr,
             success=(process.returncode == 0),
         )
     except Exception:
@@ -140,12 +270,97 @@ def run_command(command_args: list, cwd: str) -> ExecutionResult:
         return ExecutionResult(command=cmd_str)
 
 
-def send_notification(status: DeploymentStatus):
+def is_retryable_status(status_code: int) -> bool:
+    return status_code == 429 or status_code >= 500
+
+
+def get_retry_after_seconds(response: httpx.Response) -> Optional[float]:
+    if response.status_code != 429:
+        return None
+    try:
+        return max(float(response.headers["Retry-After"]), 0.0)
+    except (KeyError, ValueError):
+        # missing or an http date, fall back to our own backoff
+        return None
+
+
+async def post_with_retries(url: str, payload: dict) -> httpx.Response:
+    for attempt in range(DISCORD_POST_MAX_ATTEMPTS):
+        is_last_attempt = attempt == DISCORD_POST_MAX_ATTEMPTS - 1
+        retry_after = None
+        try:
+            response = await HTTP_CLIENT.post(
+                url, content=orjson.dumps(payload), headers={"Content-Type": "application/json"}
+            )
+        except httpx.TransportError:
+            if is_last_attempt:
+                raise
+        else:
+            if is_last_attempt or not is_retryable_status(response.status_code):
+                response.raise_for_status()
+                return response
+            retry_after = get_retry_after_seconds(response)
+            if retry_after is not None and retry_after > DISCORD_RETRY_MAX_DELAY_SECONDS:
+                # rate limited for longer than is worth holding a deployment up
+                response.raise_for_status()
+
+        delay = min(
+            DISCORD_RETRY_BASE_DELAY_SECONDS * 2**attempt + random.random() * 0.5,
+            DISCORD_RETRY_MAX_DELAY_SECONDS,
+        )
+        if retry_after is not None:
+            # discord tells us when the rate limit resets, asking sooner
+            # would just burn an attempt on another 429
+            delay = retry_after
+        logger.warning(f"discord post attempt {attempt + 1} failed, retrying in {delay:.2f}s")
+        await asyncio.sleep(delay)
+
+
+def record_discord_failure(breaker: CircuitBreaker):
+    logger.exception("Failed to send Discord notification")
+    breaker.failures += 1
+    if breaker.failures == DISCORD_CIRCUIT_BREAKER_THRESHOLD:
+        breaker.opened_at = time.time()
+        logger.error(f"opening discord circuit for {DISCORD_CIRCUIT_BREAKER_COOLDOWN_SECONDS}s")
+
+
+async def post_to_discord(payload: dict) -> bool:
     webhook_url = CICD_DISCORD_WEBHOOK_URL
     if not webhook_url:
-        logger.warning("Discord webhook URL missing from environment")
-        return
+        # already warned about once in load_config
+        logger.debug("not sending discord embed, cicd_discord_webhook_url is empty")
+        return False
+
+    breaker = DISCORD_CIRCUIT_BREAKERS.setdefault(webhook_url, CircuitBreaker())
+    if breaker.failures >= DISCORD_CIRCUIT_BREAKER_THRESHOLD:
+        if time.time() - breaker.opened_at < DISCORD_CIRCUIT_BREAKER_COOLDOWN_SECONDS:
+            logger.warning(f"not sending discord embed, circuit is open after {breaker.failures} failures")
+            return False
+        # half-open, this post goes through as a probe and the cooldown
+        # restarts so nothing else piles on while it's in flight
+        breaker.opened_at = time.time()
+
+    try:
+        await post_with_retries(webhook_url, payload)
+    except httpx.HTTPStatusError as e:
+        if not is_retryable_status(e.response.status_code):
+            # discord is up and rejected this one embed, that's no reason
+            # to stop sending the others
+            logger.error(f"Discord rejected notification with {e.response.status_code}: {e.response.text[:200]}")
+            return False
+        record_discord_failure(breaker)
+        return False
+    except httpx.TransportError:
+        record_discord_failure(breaker)
+        return False
+    except Exception:
+        logger.exception("Failed to send Discord notification")
+        return False
+    breaker.failures = 0
+    return True
 
+
+async def send_notification(status: DeploymentStatus):
     # Default to failure/neutral
     color = 0xED4245
     title = "Deployment Failed"
@@ -157,19 +372,17 @@ def send_notification(status: DeploymentStatus):
         color = 0x57F287
         title = "Deployment Successful"
 
-    env_str = f"{getpass.getuser()}@{socket.gethostname()}"
-
     commit_id_to_use = status.commit_id
 
     # assume it's an actual commit so we truncate it to the first 7
     if " " not in status.commit_id and status.commit_id is not None:
         commit_id_to_use = status.commit_id[:7]
 
-    description = (
+    description_parts = [
         f"**Repo:** `{status.repo}:{status.branch}`\n"
         f"**Commit:** `{commit_id_to_use}` — {status.commit_msg}\n"
-        f"**Author:** {status.author} | **Host:** `{env_str}`\n"
-    )
+        f"**Author:** {status.author} | **Host:** `{ENV_STR}`\n"
+    ]
 
     for execution_result in [
         status.git_execution_result,
@@ -179,55 +392,63 @@ def send_notification(status: DeploymentStatus):
         if not execution_result:
             continue
         icon = "✅" if execution_result.success else "⚠️"
-        description += f"\n{icon} `{execution_result.command}` (Exit: {execution_result.exit_code})"
+        description_parts.append(f"\n{icon} `{execution_result.command}` (Exit: {execution_result.exit_code})")
         if execution_result.stderr:
-            description += f"\n```stderr\n{execution_result.stderr}```"
+            description_parts.append(f"\n```stderr\n{execution_result.stderr}```")
+    description = "".join(description_parts)
+    if len(description) > DISCORD_EMBED_DESCRIPTION_LIMIT:
+        # a long commit message can still push it over, a 400 would lose the embed
+        description = description[:DISCORD_EMBED_DESCRIPTION_LIMIT - 4] + "\n..."
 
     payload = {"embeds": [{"title": title, "description": description, "color": color}]}
-    try:
-        requests.post(webhook_url, json=payload, timeout=10).raise_for_status()
-    except Exception:
-        logger.exception("Failed to send Discord notification")
+    await post_to_discord(payload)
 
 
-def get_docker_images_disk_usage_bytes():
-    # Docker uses SI units: 1000^n
-    UNIT_MAP = {
-        'B': 1,
-        'KB': 10**3, 'KB': 10**3, 
-        'MB': 10**6, 'MB': 10**6,
-        'GB': 10**9, 'GB': 10**9,
-        'TB': 10**12
-    }
-    try:
-        # Get docker system df output as JSON lines
-        result = subprocess.run(
-            ["docker", "system", "df", "--format", "{{json .}}"],
-            capture_output=True, text=True, check=True
-        )
-        for line in result.stdout.splitlines():
-            data = json.loads(line)
-            if data.get("Type") != "Images":
-                continue
+class DockerSocketConnection(http.client.HTTPConnection):
+    """HTTP connection to the Docker Engine API over its unix socket."""
 
-            raw_size = data.get("Size", "")  # e.g., "8.423GB"
-            match = re.match(r"([0-9.]+)\s*([a-zA-Z]+)", raw_size)
-            if not match:
-                logger.info("could not extract image disk usage from docker response of {raw_size}")
-                return None
-            
-            number, unit = match.groups()
-            # Normalize unit to uppercase for the map
-            multiplier = UNIT_MAP.get(unit.upper(), 1)
-            usage = int(float(number) * multiplier)
-            MetricsHandler.docker_image_disk_usage_bytes.set(usage)
+    def __init__(self, socket_path: str, timeout: float = 10):
+        # the host is only used for the Host header, docker ignores it
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
 
-        return None
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def get_docker_images_disk_usage_bytes() -> Optional[int]:
+    # same numbers as `docker system df`, but exact byte counts straight from
+    # the engine instead of forking the cli and parsing "8.423GB"
+    connection = DockerSocketConnection(DOCKER_SOCKET_PATH)
+    try:
+        connection.request("GET", "/system/df?type=image")
+        response = connection.getresponse()
+        body = response.read()
+        if response.status != 200:
+            logger.info(f"docker /system/df returned {response.status}: {body[:200]}")
+            return None
+
+        usage = orjson.loads(body).get("LayersSize")
+        if usage is None:
+            logger.info("could not find LayersSize in docker /system/df response")
+            return None
+        MetricsHandler.docker_image_disk_usage_bytes.set(usage)
+        return usage
     except Exception:
         logger.exception("Error getting Docker image disk usage")
+    finally:
+        connection.close()
+
 
+async def poll_docker_images_disk_usage():
+    while True:
+        await asyncio.to_thread(get_docker_images_disk_usage_bytes)
+        await asyncio.sleep(DOCKER_DISK_USAGE_POLL_INTERVAL_SECONDS)
 
-def handle_deploy(repo_cfg: RepoConfig, payload: dict, is_dev: bool):
+
+async def handle_deploy(repo_cfg: RepoConfig, payload: dict, is_dev: bool):
     MetricsHandler.last_push_timestamp.labels(repo=repo_cfg.name).set(time.time())
 
     commit = payload.get("head_commit") or {}
@@ -244,19 +465,38 @@ def handle_deploy(repo_cfg: RepoConfig, payload: dict, is_dev: bool):
 
     backup_branch = None
     if repo_cfg.enable_rollback and not is_dev:
-        backup_branch = create_backup_branch(repo_cfg)
+        backup_branch = await create_backup_branch(repo_cfg)
 
     # Git Pull
-    status.git_execution_result = run_command(
+    status.git_execution_result = await run_command(
         ["git", "pull", "origin", repo_cfg.branch], repo_cfg.path
     )
     if not status.git_execution_result.success:
         logger.error(f"Git pull failed for {repo_cfg.name}:{repo_cfg.branch}")
-        send_notification(status)
+        await send_notification(status)
+        return
+
+    # in development every command is mocked, so the heads would always match
+    key = (repo_cfg.name, repo_cfg.branch)
+    head = None
+    if not is_dev:
+        head_result = await run_command(["git", "rev-parse", "HEAD"], repo_cfg.path)
+        if head_result.success:
+            head = head_result.stdout
+
+    # a redelivered webhook or a push we already deployed leaves HEAD where
+    # it was, rebuilding the same images would just take minutes for nothing
+    if head and LAST_DEPLOYED_HEADS.get(key) == head:
+        logger.info(f"{repo_cfg.name}:{repo_cfg.branch} already deployed at {head[:7]}, skipping docker compose")
+        if backup_branch:
+            await run_command(["git", "branch", "-D", backup_branch], repo_cfg.path)
+        status.commit_msg += " [NO NEW COMMITS, REBUILD SKIPPED]"
+        await send_notification(status)
         return
+    LAST_DEPLOYED_HEADS.pop(key, None)
 
     # Docker Compose
-    status.docker_execution_result = run_command(
+    status.docker_execution_result = await run_command(
         ["docker", "compose", "up", "--build", "-d"], repo_cfg.path
     )
 
@@ -264,41 +504,44 @@ def handle_deploy(repo_cfg: RepoConfig, payload: dict, is_dev: bool):
         logger.error(f"Docker build/up failed for {repo_cfg.name}:{repo_cfg.branch}")
         
         if repo_cfg.enable_rollback and backup_branch:
-            rollback_success = perform_rollback(repo_cfg, backup_branch)
+            rollback_success = await perform_rollback(repo_cfg, backup_branch)
             if rollback_success:
                 status.commit_msg += " [ROLLED BACK DUE TO DOCKER FAILURE]"
         
-        send_notification(status)
+        await send_notification(status)
         return
 
     if repo_cfg.containers_to_force_recreate:
-        command = ["docker", "compose", "up", "--build", "-d", "--force-recreate", "--no-deps"]
+        # the images were just built by the up above, so only recreate here
+        command = ["docker", "compose", "up", "-d", "--force-recreate", "--no-deps"]
         command.extend(repo_cfg.containers_to_force_recreate)
-        status.docker_force_execution_result = run_command(command, repo_cfg.path)
+        status.docker_force_execution_result = await run_command(command, repo_cfg.path)
+
+    if head and (
+        not status.docker_force_execution_result or status.docker_force_execution_result.success
+    ):
+        LAST_DEPLOYED_HEADS[key] = head
 
     if backup_branch:
-        subprocess.run(["git", "branch", "-D", backup_branch], cwd=repo_cfg.path, capture_output=True)
+        await run_command(["git", "branch", "-D", backup_branch], repo_cfg.path)
 
     logger.error(f"deployment complete for {repo_cfg.name}:{repo_cfg.branch}")
-    send_notification(status)
-    get_docker_images_disk_usage_bytes()
+    await send_notification(status)
+    await asyncio.to_thread(get_docker_images_disk_usage_bytes)
 
 
-def push_skipped_update_as_discord_embed_mismatched_branch(
+async def push_skipped_update_as_discord_embed_mismatched_branch(
     repo_config: RepoConfig, incoming_branch: str, local_branch: str
 ):
     repo_name = repo_config.name
     # Yellow warning color
     color = 0xFFFF00 
-    
-    # Get user@hostname
-    env_str = f"{getpass.getuser()}@{socket.gethostname()}"
 
     description = (
         f"**Incoming Push:** `{incoming_branch}`\n"
         f"**Local Branch:** `{local_branch}`\n"
         f"**Path:** `{repo_config.path}`\n"
-        f"**Host:** `{env_str}`"
+        f"**Host:** `{ENV_STR}`"
     )
 
     embed_json = {
@@ -314,43 +557,29 @@ def push_skipped_update_as_discord_embed_mismatched_branch(
             }
         ]
     }
-    
-    try:
-        response = requests.post(
-            CICD_DISCORD_WEBHOOK_URL,
-            json=embed_json,
-            timeout=10
-        )
-        response.raise_for_status()
-        logger.info(f"Mismatch notification sent for {repo_name}")
-    except Exception:
-        logger.exception("Failed to send mismatch notification to Discord")
 
+    if await post_to_discord(embed_json):
+        logger.info(f"Mismatch notification sent for {repo_name}")
 
-def push_skipped_update_as_discord_embed_docker_ignore(repo_cfg: RepoConfig, files_changed: List[str]):
-    webhook_url = CICD_DISCORD_WEBHOOK_URL
-    if not webhook_url:
-        logger.info("skipping docker embed, cicd_discord_webhook_url is empty")
-        return
 
+async def push_skipped_update_as_discord_embed_docker_ignore(repo_cfg: RepoConfig, files_changed: List[str]):
     # A neutral Blue/Grey color for "Informational"
     color = 0x3498db 
     title = "Deployment Skipped (Ignored Files)"
     
     # Truncate file list if it's too long for Discord
-    files_display = "\n".join(files_changed[:10])
+    files_display_parts = files_changed[:10]
     if len(files_changed) > 10:
-        files_display += f"\n*...and {len(files_changed) - 10} more*"
+        files_display_parts.append(f"*...and {len(files_changed) - 10} more*")
+    files_display = "\n".join(files_display_parts)
 
     patterns_display = ", ".join([f"`{p}`" for p in repo_cfg.docker_ignore])
-    env_str = f"{getpass.getuser()}@{socket.gethostname()}"
-
     description = (
         f"**Repo:** `{repo_cfg.name}:{repo_cfg.branch}`\n"
         f"**Status:** No deployment triggered because all changed files match the `docker_ignore` patterns.\n\n"
         f"**Matched Patterns:** {patterns_display}\n"
         f"**Files Changed:**\n```\n{files_display}\n```\n"
-        f"**Host:** `{env_str}`"
+        f"**Host:** `{ENV_STR}`"
     )
 
     payload = {
@@ -362,10 +591,7 @@ def push_skipped_update_as_discord_embed_docker_ignore(repo_cfg: RepoConfig, fil
         }]
     }
 
-    try:
-        requests.post(webhook_url, json=payload, timeout=10)
-    except Exception:
-        logger.exception("Failed to send skip notification")
+    await post_to_discord(payload)
 
 
 def should_skip_deployment(files_changed: List[str], ignore_patterns: List[str]) -> bool:
@@ -390,95 +616,147 @@ def should_skip_deployment(files_changed: List[str], ignore_patterns: List[str])
     return True
 
 
-app = FastAPI()
-app.add_middleware(
-    CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]
-)
-
 REPO_MAP: Dict[Tuple[str, str], RepoConfig] = {}
 
+
 # dis one loads the config.yml file
 # turns it into a dictionary
 # result is the dictionary
-try:
-    with open(args.config) as f:
-        data = yaml.safe_load(f)
-        raw_repos = data.get("repos", [])
-        SMEE2_URL = data.get("smee2_url")
-        SMEE2_API_KEY = data.get("smee2_api_key")
-        CICD_DISCORD_WEBHOOK_URL = data.get("cicd_discord_webhook_url")
-        for r in raw_repos:
-            # make a new entry into the result dictionary
-            # the key is a tuple of the repo name and branch
-            # the value is a RepoToWatch object
-            unknown_fields = validate_config(r)
-            if unknown_fields: # removes any extra fields not in RepoConfig
-                for f in unknown_fields:
-                    r.pop(f)
-            cfg = RepoConfig(**r)
-            REPO_MAP[(cfg.name, cfg.branch)] = cfg
-        logger.info(f'loaded {len(raw_repos)} repo(s) from config {args.config}')
-except Exception:
-    logger.exception(f"Failed to load config at path {args.config}")
-
-def deployment_worker(target: RepoConfig, is_dev: bool):
-    key = (target.name, target.branch)
-    q = REPO_QUEUES[key]
+def load_config():
+    global SMEE2_URL, SMEE2_API_KEY, CICD_DISCORD_WEBHOOK_URL
+    if not yaml.__with_libyaml__:
+        logger.info("pyyaml was built without libyaml, loading config with the pure python loader")
+    try:
+        with open(args.config) as f:
+            data = yaml.load(f, Loader=YAML_LOADER)
+            raw_repos = data.get("repos", [])
+            SMEE2_URL = data.get("smee2_url")
+            SMEE2_API_KEY = data.get("smee2_api_key")
+            CICD_DISCORD_WEBHOOK_URL = data.get("cicd_discord_webhook_url")
+            for r in raw_repos:
+                # make a new entry into the result dictionary
+                # the key is a tuple of the repo name and branch
+                # the value is a RepoToWatch object
+                unknown_fields = validate_config(r)
+                if unknown_fields: # removes any extra fields not in RepoConfig
+                    for f in unknown_fields:
+                        r.pop(f)
+                cfg = RepoConfig(**r)
+                # interned so the lookup for every smee event can compare
+                # the key strings by identity, see get_event_target
+                cfg.name = sys.intern(cfg.name)
+                cfg.branch = sys.intern(cfg.branch)
+                REPO_MAP[(cfg.name, cfg.branch)] = cfg
+            logger.info(f'loaded {len(raw_repos)} repo(s) from config {args.config}')
+            if not CICD_DISCORD_WEBHOOK_URL:
+                logger.warning(f"cicd_discord_webhook_url is empty in {args.config}, no discord embeds will be sent")
+    except Exception:
+        logger.exception(f"Failed to load config at path {args.config}")
 
+
+def try_become_leader() -> bool:
+    global LEADER_LOCK_FILE
+    try:
+        import fcntl
+    except ImportError:
+        # no flock on windows, fine as long as we're the only process
+        if args.development or args.workers == 1:
+            return True
+        raise SystemExit("--workers > 1 needs fcntl.flock, which this platform doesn't have")
+    lock_file = open(LEADER_LOCK_PATH, "w")
     try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return False
+    LEADER_LOCK_FILE = lock_file
+    return True
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    # runs once per worker after uvicorn has imported us, so a --reload
+    # doesn't redo any of this while it's importing the module
+    global EVENT_LOOP, EVENT_QUEUE, HTTP_CLIENT
+    MetricsHandler.init()
+    load_config()
+    if not try_become_leader():
+        logger.info(f"another worker holds {LEADER_LOCK_PATH}, only serving http")
+        yield
+        return
+
+    logger.info(f"acquired {LEADER_LOCK_PATH}, this worker listens to smee")
+    EVENT_LOOP = asyncio.get_running_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=BLOCKING_EXECUTOR_MAX_WORKERS, thread_name_prefix="Blocking"
+    )
+    EVENT_LOOP.set_default_executor(executor)
+    EVENT_QUEUE = asyncio.Queue(maxsize=EVENT_QUEUE_MAX_SIZE)
+    # discord is the only host we talk to, a couple of pooled connections
+    # cover a deployment racing a skip notification
+    HTTP_CLIENT = httpx.AsyncClient(
+        timeout=10.0,
+        limits=httpx.Limits(max_connections=4, max_keepalive_connections=2),
+    )
+    disk_usage_task = asyncio.create_task(poll_docker_images_disk_usage())
+    dispatcher_task = asyncio.create_task(dispatch_smee_events())
+    # websocket-client blocks on recv, keep it off the event loop
+    threading.Thread(target=smee_listen, daemon=True, name="SmeeListener").start()
+    yield
+    disk_usage_task.cancel()
+    dispatcher_task.cancel()
+    # nothing schedules new work once the dispatcher is gone, let what's
+    # running wrap up while the client and executor are still open
+    if BACKGROUND_TASKS:
+        _, still_running = await asyncio.wait(
+            BACKGROUND_TASKS, timeout=BACKGROUND_TASKS_SHUTDOWN_GRACE_SECONDS
+        )
+        for task in still_running:
+            task.cancel()
+        await asyncio.gather(*still_running, return_exceptions=True)
+    executor.shutdown(wait=False, cancel_futures=True)
+    await HTTP_CLIENT.aclose()
+
+
+# no CORSMiddleware, nothing here is called from a browser, only prometheus
+# scrapes /metrics and github traffic comes in over the smee websocket
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+
+
+async def deploy_coalesced(target: RepoConfig, data: dict, is_dev: bool):
+    key = (target.name, target.branch)
+    lock = DEPLOY_LOCKS.setdefault(key, asyncio.Lock())
+
+    # debounce: someone is already waiting on the lock, hand them our
+    # newer payload instead of queueing up another full deployment
+    if key in PENDING_DEPLOYS:
+        logger.info(f"Discarding outdated request for {target.name} (newer one waiting)")
+        PENDING_DEPLOYS[key] = data
+        return
+
+    PENDING_DEPLOYS[key] = data
+    async with lock:
         # hai welcome to the deployment house
-        while True:
-            # kicking a guy outta line rn brb
-            payload = q.get()
-            
-            # debounce,: skip the stale entriesand grab the newest one.
-            # this disqualifies the older waiting deployments
-            while not q.empty():
-                logger.info(f"Discarding outdated request for {target.name} (newer one waiting)")
-                payload = q.get()
-
-            try:
-                handle_deploy(target, payload, is_dev)
-            except Exception:
-                logger.exception(f"Worker failed during deploy of {target.name}")
-            finally:
-                q.task_done()
-
-            with THREAD_MANAGER_LOCK:
-                if q.empty():
-                    ACTIVE_WORKERS.remove(key)
-                    logger.info(f"Worker for {target.name} exiting (queue empty)")
-                    return
-    except Exception:
-        logger.exception(f"Fatal error in worker thread for {target.name}")
-        with THREAD_MANAGER_LOCK:
-            ACTIVE_WORKERS.discard(key)
+        payload = PENDING_DEPLOYS.pop(key)
+        try:
+            await handle_deploy(target, payload, is_dev)
+        except Exception:
+            logger.exception(f"Worker failed during deploy of {target.name}")
+
+
+def run_in_background(coro):
+    # the dispatcher hands work off like this so one repo's deployment or a
+    # slow discord post never holds up events for the other repos
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
 
 
 def trigger_deployment(target: RepoConfig, data: dict, is_dev: bool):
-    key = (target.name, target.branch)
-    
-    with THREAD_MANAGER_LOCK:
-        # Create queue if it doesn't exist
-        if key not in REPO_QUEUES:
-            REPO_QUEUES[key] = queue.Queue()
-        
-        # Add the work to the queue
-        REPO_QUEUES[key].put(data)
-        
-        # If no worker is running for this repo, start one
-        if key not in ACTIVE_WORKERS:
-            ACTIVE_WORKERS.add(key)
-            t = threading.Thread(
-                target=deployment_worker, 
-                args=(target, is_dev), 
-                daemon=True,
-                name=f"Worker-{target.name}"
-            )
-            t.start()
-            logger.info(f"Started new worker thread for {target.name}")
+    run_in_background(deploy_coalesced(target, data, is_dev))
+    logger.info(f"Scheduled deployment for {target.name}:{target.branch}")
 
-def handle_workflow_run_event(payload: dict, target: RepoConfig):
+async def handle_workflow_run_event(payload: dict, target: RepoConfig):
     if not target.actions_need_to_pass:
         return {"status": "ignored", "reason": f"actions_need_to_pass is not set to True for {target.name}:{target.branch}"}
 
@@ -499,32 +777,29 @@ def handle_workflow_run_event(payload: dict, target: RepoConfig):
             }
         }
         
-        trigger_deployment(target, payload, args.development)
+        trigger_deployment(target, push_payload, args.development)
         return {"status": "accepted", "reason": "workflow success triggered deploy"}
 
     return {"status": "ignored", "reason": f"Workflow state {action}/{conclusion} does not trigger deploy"}
 
 
-def handle_push_event(data: dict, target: RepoConfig):
+async def handle_push_event(data: dict, target: RepoConfig):
     """Handles logic specific to GitHub 'push' events."""
     if target.actions_need_to_pass:
         return {"status": "ignored", "reason": "actions_need_to_pass is set to True, waiting for workflow_run success"}
 
     repo_name = target.name
-    branch = data.get("ref", "").split("/")[-1]
+    branch = data.get("ref", "").rpartition("/")[2]
 
     if not args.development:
-        current_branch_result = subprocess.run(
-            ["git", "rev-parse", "--abbrev-ref", "HEAD"],
-            cwd=target.path,
-            capture_output=True,
-            text=True,
+        current_branch_result = await run_command(
+            ["git", "rev-parse", "--abbrev-ref", "HEAD"], target.path
         )
-        current_branch = current_branch_result.stdout.strip()
+        current_branch = current_branch_result.stdout
 
         if current_branch != branch:
             logger.warning(f"Branch mismatch for {repo_name}")
-            push_skipped_update_as_discord_embed_mismatched_branch(target, branch, current_branch)
+            run_in_background(push_skipped_update_as_discord_embed_mismatched_branch(target, branch, current_branch))
             return {"status": "skipped", "reason": "branch mismatch"}
 
     head_commit = data.get("head_commit") or {}
@@ -536,53 +811,113 @@ def handle_push_event(data: dict, target: RepoConfig):
 
     if should_skip_deployment(files_changed, target.docker_ignore):
         logger.info(f"Skipping deployment for {repo_name}: All files match docker_ignore.")
-        push_skipped_update_as_discord_embed_docker_ignore(target, files_changed)
+        run_in_background(push_skipped_update_as_discord_embed_docker_ignore(target, files_changed))
         return {"status": "skipped", "reason": "all changed files ignored"}
 
     logger.info(f"Accepted push for {repo_name}:{branch}")
-    trigger_deployment(target, data, args.development)
+    # only hold on to what handle_deploy reads, not every commit and file
+    # list in the push while the deployment waits for its lock
+    push_payload = {
+        "head_commit": {
+            field: head_commit[field] for field in ("id", "message", "author") if field in head_commit
+        }
+    }
+    trigger_deployment(target, push_payload, args.development)
     return {"status": "accepted"}
 
-def create_backup_branch(repo_cfg: RepoConfig) -> Optional[str]:
+async def create_backup_branch(repo_cfg: RepoConfig) -> Optional[str]:
     """Creates a temporary local branch to save the current state before pulling."""
     timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
     backup_name = f"backup-{timestamp}-{repo_cfg.branch}"
-    try:
-        subprocess.run(["git", "checkout", repo_cfg.branch], cwd=repo_cfg.path, check=True, capture_output=True)
-        subprocess.run(["git", "branch", backup_name], cwd=repo_cfg.path, check=True, capture_output=True)
-        logger.info(f"Created backup snapshot: {backup_name}")
-        return backup_name
-    except Exception:
-        logger.exception(f"Failed to create backup for {repo_cfg.name}:{repo_cfg.branch}")
-        return None
-
-def perform_rollback(repo_cfg: RepoConfig, backup_name: str):
+    for command in (["git", "checkout", repo_cfg.branch], ["git", "branch", backup_name]):
+        result = await run_command(command, repo_cfg.path)
+        if not result.success:
+            logger.error(f"Failed to create backup for {repo_cfg.name}:{repo_cfg.branch}: {result.stderr}")
+            return None
+    logger.info(f"Created backup snapshot: {backup_name}")
+    return backup_name
+
+async def perform_rollback(repo_cfg: RepoConfig, backup_name: str) -> bool:
     """Resets the branch to the backup and restarts the containers."""
+    logger.warning(f"Rolling back {repo_cfg.name} to {backup_name}")
     try:
-        logger.warning(f"Rolling back {repo_cfg.name} to {backup_name}")
-        # reset the local branch to exactly what was in the backup
-        subprocess.run(["git", "reset", "--hard", backup_name], cwd=repo_cfg.path, check=True)
-        # restart docker with the old (working) code
-        subprocess.run(["docker", "compose", "up", "--build", "-d"], cwd=repo_cfg.path, check=True)
+        for command in (
+            # reset the local branch to exactly what was in the backup
+            ["git", "reset", "--hard", backup_name],
+            # restart docker with the old (working) code
+            ["docker", "compose", "up", "--build", "-d"],
+        ):
+            result = await run_command(command, repo_cfg.path)
+            if not result.success:
+                logger.error(
+                    f"Rollback failed for {repo_cfg.name}:{repo_cfg.branch}, "
+                    f"`{result.command}` exited with {result.exit_code}: {result.stderr}"
+                )
+                return False
         return True
-    except Exception:
-        logger.exception(f"Rollback failed for {repo_cfg.name}:{repo_cfg.branch}")
-        return False
     finally:
         # delete the backup branch after reset
-        subprocess.run(["git", "branch", "-D", backup_name], cwd=repo_cfg.path, capture_output=True)
+        await run_command(["git", "branch", "-D", backup_name], repo_cfg.path)
 
 
 @app.get("/metrics")
-def get_metrics():
-    return Response(media_type="text/plain", content=generate_latest())
+async def get_metrics():
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        # merge what every worker wrote, otherwise the answer depends on
+        # which worker picked up the scrape
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(media_type=CONTENT_TYPE_LATEST, content=generate_latest(registry))
+    return Response(media_type=CONTENT_TYPE_LATEST, content=generate_latest())
 
 
 @app.get("/")
-def health():
+async def health():
     return {"status": "ok", "dev_mode": args.development}
 
 
+def get_event_target(data: dict) -> Tuple[Optional[str], Optional[RepoConfig]]:
+    # we used to get it like
+    # event = request.headers.get("X-GitHub-Event")
+    # but smee doesn't forward headers, so tell the event apart by its payload
+    # before touching anything else in it
+    if data.get("pusher"):
+        event = "push"
+        branch = data.get("ref", "").rpartition("/")[2]
+    elif data.get("workflow_run"):
+        event = "workflow_run"
+        branch = data["workflow_run"].get("head_branch")
+    else:
+        # ping, pull_request, issues, ... nothing we deploy on
+        return None, None
+
+    repo_name = data.get("repository", {}).get("name")
+    if not isinstance(repo_name, str) or not isinstance(branch, str):
+        return event, None
+    target = REPO_MAP.get((sys.intern(repo_name), sys.intern(branch)))
+
+    if not target:
+        logger.debug(f"No configuration found for {repo_name}:{branch}")
+    return event, target
+
+
+async def handle_smee_message(data: dict, event: str, target: RepoConfig):
+    try:
+        if event == "push":
+            await handle_push_event(data, target)
+        elif event == "workflow_run":
+            await handle_workflow_run_event(data, target)
+    except Exception:
+        logger.exception(f"Failed to handle {event} event for {target.name}:{target.branch}")
+
+
+async def dispatch_smee_events():
+    while True:
+        data, event, target = await EVENT_QUEUE.get()
+        await handle_smee_message(data, event, target)
+        EVENT_QUEUE.task_done()
+
+
 def smee_listen():
     url = SMEE2_URL
     if not url:
@@ -600,36 +935,25 @@ def smee_listen():
             message = ws.recv()
             MetricsHandler.last_smee_request_timestamp.set(time.time())
 
-            data = json.loads(message)
+            # push payloads for big repos can be 100KB+, orjson parses them
+            # several times faster than the json module
+            data = orjson.loads(message)
+            # every message is kept, the untracked ones are how you find out
+            # why a push didn't deploy
             with open('idk.jsonl', 'a') as f:
                 f.write('\n')
                 f.write(message)
-            # we used to get it like
-            # event = request.headers.get("X-GitHub-Event")
-            event = None
-            repositiory = data.get("repository", {})
-
-
-            repo_name = repositiory.get("name")
-            branch = None
-            
-            if data.get("pusher"):
-                branch = data.get("ref", "").split("/")[-1]
-                event = "push"
-            elif data.get("workflow_run"):
-                branch = data.get("workflow_run", {}).get("head_branch")
-                event = "workflow_run"
-
-            target = REPO_MAP.get((repo_name, branch))
-
+            # drop pushes for repos and branches we don't deploy right here,
+            # before they cost a trip to the event loop
+            event, target = get_event_target(data)
             if not target:
-                logger.debug(f"No configuration found for {repo_name}:{branch}")
                 continue
 
-            if event == "push":
-                handle_push_event(data, target)
-            elif event == "workflow_run":
-                handle_workflow_run_event(data, target)
+            # handled by dispatch_smee_events on the event loop, this only
+            # blocks if the queue is full
+            asyncio.run_coroutine_threadsafe(
+                EVENT_QUEUE.put((data, event, target)), EVENT_LOOP
+            ).result()
                 
     except websocket.WebSocketConnectionClosedException:
         logger.warning("Smee WebSocket connection closed by the server.")
@@ -640,11 +964,24 @@ def smee_listen():
             ws.close()
 
 
-if __name__ == "server":
-    MetricsHandler.init()
-    get_docker_images_disk_usage_bytes()
-    smee_listen()
+def prepare_prometheus_multiprocess_dir():
+    # the workers inherit this env var from us and keep their metrics as files
+    # in this directory instead of in memory
+    path = os.environ.setdefault(
+        "PROMETHEUS_MULTIPROC_DIR",
+        os.path.join(tempfile.gettempdir(), f"sce-cicd-{args.port}-prometheus"),
+    )
+    os.makedirs(path, exist_ok=True)
+    # files left over from a previous run would be merged into ours
+    for name in os.listdir(path):
+        if name.endswith(".db"):
+            os.remove(os.path.join(path, name))
 
 
 if __name__ == "__main__":
-    uvicorn.run("server:app", port=args.port, reload=True)
+    if args.development:
+        uvicorn.run("server:app", port=args.port, reload=True)
+    else:
+        if args.workers > 1:
+            prepare_prometheus_multiprocess_dir()
+        uvicorn.run("server:app", port=args.port, workers=args.workers)